@@ -12,13 +12,50 @@ License: BSD
 
 from __future__ import print_function
 
+from collections import defaultdict
 from itertools import combinations, permutations
 import logging
+import sys
 
 import networkx as nx
 
 _logger = logging.getLogger(__name__)
 
+# The CI test function and its arguments, set in each worker process
+# by _init_ci_test_worker().
+_ci_test_args = None
+
+def _init_ci_test_worker(indep_test_func, data_matrix, kwargs):
+    global _ci_test_args
+    _ci_test_args = (indep_test_func, data_matrix, kwargs)
+
+def _run_ci_test(job):
+    (indep_test_func, data_matrix, kwargs) = _ci_test_args
+    (i, j, k) = job
+    return indep_test_func(data_matrix, i, j, set(k), **kwargs)
+
+def _create_ci_test_executor(indep_test_func, data_matrix, kwargs):
+    """Create a process pool to run CI tests in parallel.
+
+    Args:
+        indep_test_func: the function for a conditional independency
+            test (must be picklable).
+        data_matrix: data (as a numpy array).
+        kwargs: the parameters passed to indep_test_func().  The
+            number of processes is taken from 'max_workers'.
+
+    Returns:
+        A concurrent.futures.ProcessPoolExecutor.
+    """
+    # The initializer argument of ProcessPoolExecutor needs 3.7.
+    if sys.version_info < (3, 7):
+        raise ValueError('max_workers requires Python 3.7 or later')
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=kwargs['max_workers'],
+                               initializer=_init_ci_test_worker,
+                               initargs=(indep_test_func, data_matrix,
+                                         kwargs))
+
 def _create_complete_graph(node_ids):
     """Create a complete graph from the list of node ids.
 
@@ -46,18 +83,36 @@ def estimate_skeleton(indep_test_func, data_matrix, alpha, **kwargs):
             'max_reach': maximum value of l (see the code).  The
                 value depends on the underlying distribution.
             'method': if 'stable' given, use stable-PC algorithm
-                (see [Colombo2014]).
+                (see [Colombo2014]).  Once a pair is separated at a
+                level, it is not tested again from the other side, so
+                its separation set is the first one found rather than
+                the union of those found for (i, j) and (j, i).
             'init_graph': initial structure of skeleton graph
                 (as a networkx.Graph). If not specified,
                 a complete graph is used.
             'fixed_edges': Undirected edges marked here are not changed
                 (as a networkx.Graph). If not specified,
                 an empty graph is used.
+            'max_workers': run the CI tests of each level in parallel
+                using this number of processes (None means the number
+                of CPUs).  Requires 'method' set to 'stable' and
+                Python 3.7 or later.  indep_test_func must be
+                picklable.  All the conditioning sets of a level are
+                tested speculatively, without stopping at the first
+                separating set, so this runs more tests than the
+                sequential search (about twice as many is common).
+                It only pays off with clearly more cores than that
+                overhead and expensive CI tests; the result is the
+                same either way.  The jobs of a whole level and their
+                cached results are also held in memory at once.
             other parameters may be passed depending on the
                 indep_test_func()s.
     Returns:
         g: a skeleton graph (as a networkx.Graph).
-        sep_set: a separation set (as an 2D-array of set()).
+        sep_set: separation sets (as a dict of set() keyed by the
+            pair of nodes (i, j); both (i, j) and (j, i) are set).
+            Pairs not adjacent in 'init_graph' map to None, and
+            pairs that were never separated are absent.
 
     [Colombo2014] Diego Colombo and Marloes H Maathuis. Order-independent
     constraint-based causal structure learning. In The Journal of Machine
@@ -67,9 +122,30 @@ def estimate_skeleton(indep_test_func, data_matrix, alpha, **kwargs):
     def method_stable(kwargs):
         return ('method' in kwargs) and kwargs['method'] == "stable"
 
+    def prefetch_ci_tests(executor, ci_cache, fixed_edges, edges, adj, l):
+        # The edges do not change during a level of the stable
+        # variant, so all the tests of the level can be run in
+        # parallel up front.  The results go to ci_cache, from which
+        # the main loop below picks them up in its usual order.  Where
+        # the main loop stops for a pair depends on the p-values, so
+        # it is not known here and every subset is tested.
+        jobs = []
+        for (i, j) in edges + [(j, i) for (i, j) in edges]:
+            if (i, j) in fixed_edges:
+                continue
+            for k in combinations(sorted(adj[i] - {j}), l):
+                key = (min(i, j), max(i, j), frozenset(k))
+                if key not in ci_cache:
+                    ci_cache[key] = None
+                    jobs.append((i, j, k))
+        if len(jobs) == 0:
+            return
+        p_vals = executor.map(_run_ci_test, jobs, chunksize=64)
+        for ((i, j, k), p_val) in zip(jobs, p_vals):
+            ci_cache[(min(i, j), max(i, j), frozenset(k))] = p_val
+
     node_ids = range(data_matrix.shape[1])
-    node_size = data_matrix.shape[1]
-    sep_set = [[set() for i in range(node_size)] for j in range(node_size)]
+    sep_set = defaultdict(set)
     if 'init_graph' in kwargs:
         g = kwargs['init_graph']
         if not isinstance(g, nx.Graph):
@@ -78,8 +154,8 @@ def estimate_skeleton(indep_test_func, data_matrix, alpha, **kwargs):
             raise ValueError('init_graph not matching data_matrix shape')
         for (i, j) in combinations(node_ids, 2):
             if not g.has_edge(i, j):
-                sep_set[i][j] = None
-                sep_set[j][i] = None
+                sep_set[(i, j)] = None
+                sep_set[(j, i)] = None
     else:
         g = _create_complete_graph(node_ids)
 
@@ -94,50 +170,91 @@ def estimate_skeleton(indep_test_func, data_matrix, alpha, **kwargs):
             fixed_edges.add((i, j))
             fixed_edges.add((j, i))
 
+    # The executor is shared by all the levels so that the workers
+    # and their copy of data_matrix are set up only once.
+    executor = None
+    if 'max_workers' in kwargs:
+        if not method_stable(kwargs):
+            raise ValueError('max_workers requires method "stable"')
+        executor = _create_ci_test_executor(indep_test_func, data_matrix,
+                                            kwargs)
     l = 0
-    while True:
-        cont = False
-        remove_edges = []
-        for (i, j) in permutations(node_ids, 2):
-            if (i, j) in fixed_edges:
-                continue
+    try:
+        while True:
+            # The CI tests are symmetric in i and j, so results are cached
+            # by the unordered pair and the conditioning set.  The sets
+            # have size l, so the cache is only kept for this level.
+            ci_cache = {}
+            remove_edges = []
+            removed = set()
+            # Only the pairs adjacent at the beginning of this level need
+            # to be tested.  Sorting keeps the order of permutations().
+            edges = list(g.edges())
+            adj = {n: set(g._adj[n]) for n in node_ids}
+            if executor is not None:
+                prefetch_ci_tests(executor, ci_cache, fixed_edges,
+                                  edges, adj, l)
+            for (i, j) in sorted(edges + [(j, i) for (i, j) in edges]):
+                if (i, j) in fixed_edges:
+                    continue
+                if j not in adj[i]:
+                    continue
+                # The stable variant defers removals until the end of the
+                # level; do not test (j, i) again once (i, j) is separated.
+                if frozenset((i, j)) in removed:
+                    continue
 
-            adj_i = list(g.neighbors(i))
-            if j not in adj_i:
-                continue
-            else:
-                adj_i.remove(j)
-            if len(adj_i) >= l:
-                _logger.debug('testing %s and %s' % (i,j))
-                _logger.debug('neighbors of %s are %s' % (i, str(adj_i)))
+                # Take the neighbors from g so that combinations()
+                # follows the order of g.neighbors(i), not the hash order
+                # of adj[i].  The stable variant leaves g unchanged during
+                # a level, and the other one removes edges from g at once.
+                adj_i = [n for n in g._adj[i] if n != j]
                 if len(adj_i) < l:
                     continue
+                _logger.debug('testing %s and %s', i, j)
+                _logger.debug('neighbors of %s are %s', i, adj_i)
                 for k in combinations(adj_i, l):
-                    _logger.debug('indep prob of %s and %s with subset %s'
-                                  % (i, j, str(k)))
-                    p_val = indep_test_func(data_matrix, i, j, set(k),
-                                            **kwargs)
-                    _logger.debug('p_val is %s' % str(p_val))
+                    _logger.debug('indep prob of %s and %s with subset %s',
+                                  i, j, k)
+                    key = (min(i, j), max(i, j), frozenset(k))
+                    p_val = ci_cache.get(key)
+                    if p_val is None:
+                        # The test functions in gsq consume s with pop(),
+                        # so each call needs a set of its own.
+                        p_val = indep_test_func(data_matrix, i, j, set(k),
+                                                **kwargs)
+                        ci_cache[key] = p_val
+                    _logger.debug('p_val is %s', p_val)
                     if p_val > alpha:
-                        if g.has_edge(i, j):
-                            _logger.debug('p: remove edge (%s, %s)' % (i, j))
+                        if j in g._adj[i]:
+                            _logger.debug('p: remove edge (%s, %s)', i, j)
                             if method_stable(kwargs):
                                 remove_edges.append((i, j))
+                                removed.add(frozenset((i, j)))
                             else:
                                 g.remove_edge(i, j)
-                        sep_set[i][j] |= set(k)
-                        sep_set[j][i] |= set(k)
+                                adj[i].discard(j)
+                                adj[j].discard(i)
+                        sep_set[(i, j)].update(k)
+                        sep_set[(j, i)].update(k)
                         break
-                cont = True
-        l += 1
-        if method_stable(kwargs):
-            g.remove_edges_from(remove_edges)
-        if cont is False:
-            break
-        if ('max_reach' in kwargs) and (l > kwargs['max_reach']):
-            break
-
-    return (g, sep_set)
+            l += 1
+            if method_stable(kwargs):
+                g.remove_edges_from(remove_edges)
+            # No pair can be tested at the next level unless a node has
+            # more than l neighbors.
+            max_degree = max([len(g._adj[n]) for n in node_ids] or [0])
+            if max_degree - 1 < l:
+                break
+            if ('max_reach' in kwargs) and (l > kwargs['max_reach']):
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Return a plain dict so that reading a missing pair does not
+    # insert an empty separating set.
+    return (g, dict(sep_set))
 
 def estimate_cpdag(skel_graph, sep_set):
     """Estimate a CPDAG from the skeleton graph and separation sets
@@ -145,115 +262,120 @@ def estimate_cpdag(skel_graph, sep_set):
 
     Args:
         skel_graph: A skeleton graph (an undirected networkx.Graph).
-        sep_set: An 2D-array of separation set.
+        sep_set: A dict of separation sets keyed by the pair of nodes.
             The contents look like something like below.
-                sep_set[i][j] = set([k, l, m])
+                sep_set[(i, j)] = set([k, l, m])
+            A missing pair is treated as separated by the empty set.
 
     Returns:
         An estimated DAG.
     """
     dag = skel_graph.to_directed()
-    node_ids = skel_graph.nodes()
+    node_ids = list(skel_graph.nodes())
+
+    # Keep the adjacency of the DAG as bit matrices for the steps
+    # below.  Each node is given a bit position (index[n]; node_ids
+    # maps it back to the node), so any hashable node label works.
+    # Bit index[j] of succ[i] is set when there is an arrow i->j, and
+    # bit index[i] of pred[j] is set for the same arrow.
+    index = dict((n, p) for (p, n) in enumerate(node_ids))
+    succ = dict((i, 0) for i in node_ids)
+    pred = dict((i, 0) for i in node_ids)
+    for (i, j) in dag.edges():
+        succ[i] |= 1 << index[j]
+        pred[j] |= 1 << index[i]
+
+    def _has_edge(succ, i, j):
+        return (succ[i] >> index[j]) & 1
+
+    def _has_both_edges(succ, i, j):
+        return _has_edge(succ, i, j) & _has_edge(succ, j, i)
+
+    def _has_any_edge(succ, i, j):
+        return _has_edge(succ, i, j) | _has_edge(succ, j, i)
+
+    # The steps work on the bit matrices only; the arrows removed from
+    # them are removed from the DAG at once at the end.
+    remove_edges = []
+
+    def _remove_edge(succ, pred, i, j):
+        succ[i] &= ~(1 << index[j])
+        pred[j] &= ~(1 << index[i])
+        remove_edges.append((i, j))
+
     for (i, j) in combinations(node_ids, 2):
-        adj_i = set(dag.successors(i))
-        if j in adj_i:
+        if _has_any_edge(succ, i, j):
             continue
-        adj_j = set(dag.successors(j))
-        if i in adj_j:
+        sep_ij = sep_set.get((i, j), set())
+        if sep_ij is None:
             continue
-        if sep_set[i][j] is None:
-            continue
-        common_k = adj_i & adj_j
-        for k in common_k:
-            if k not in sep_set[i][j]:
-                if dag.has_edge(k, i):
-                    _logger.debug('S: remove edge (%s, %s)' % (k, i))
-                    dag.remove_edge(k, i)
-                if dag.has_edge(k, j):
-                    _logger.debug('S: remove edge (%s, %s)' % (k, j))
-                    dag.remove_edge(k, j)
-
-    def _has_both_edges(dag, i, j):
-        return dag.has_edge(i, j) and dag.has_edge(j, i)
-
-    def _has_any_edge(dag, i, j):
-        return dag.has_edge(i, j) or dag.has_edge(j, i)
-
-    def _has_one_edge(dag, i, j):
-        return ((dag.has_edge(i, j) and (not dag.has_edge(j, i))) or
-                (not dag.has_edge(i, j)) and dag.has_edge(j, i))
-
-    def _has_no_edge(dag, i, j):
-        return (not dag.has_edge(i, j)) and (not dag.has_edge(j, i))
+        # For all the nodes k where i->k and j->k,
+        common_k = succ[i] & succ[j]
+        while common_k:
+            bit = common_k & -common_k
+            common_k ^= bit
+            k = node_ids[bit.bit_length() - 1]
+            if k not in sep_ij:
+                if _has_edge(succ, k, i):
+                    _logger.debug('S: remove edge (%s, %s)', k, i)
+                    _remove_edge(succ, pred, k, i)
+                if _has_edge(succ, k, j):
+                    _logger.debug('S: remove edge (%s, %s)', k, j)
+                    _remove_edge(succ, pred, k, j)
 
     # For all the combination of nodes i and j, apply the following
     # rules.
-    old_dag = dag.copy()
+    pairs = list(permutations(node_ids, 2))
+    old_succ = dict(succ)
     while True:
-        for (i, j) in permutations(node_ids, 2):
+        for (i, j) in pairs:
+            # All the rules below apply only to i-j.  Once a rule
+            # orients i-j, the remaining ones are skipped.
+            if not _has_both_edges(succ, i, j):
+                continue
+
             # Rule 1: Orient i-j into i->j whenever there is an arrow k->i
             # such that k and j are nonadjacent.
             #
-            # Check if i-j.
-            if _has_both_edges(dag, i, j):
-                # Look all the predecessors of i.
-                for k in dag.predecessors(i):
-                    # Skip if there is an arrow i->k.
-                    if dag.has_edge(i, k):
-                        continue
-                    # Skip if k and j are adjacent.
-                    if _has_any_edge(dag, k, j):
-                        continue
-                    # Make i-j into i->j
-                    _logger.debug('R1: remove edge (%s, %s)' % (j, i))
-                    dag.remove_edge(j, i)
-                    break
+            # Find nodes k where k->i and k and j are nonadjacent.
+            preds_i = pred[i] & ~succ[i]
+            if preds_i & ~(succ[j] | pred[j]):
+                # Make i-j into i->j
+                _logger.debug('R1: remove edge (%s, %s)', j, i)
+                _remove_edge(succ, pred, j, i)
+                continue
 
             # Rule 2: Orient i-j into i->j whenever there is a chain
             # i->k->j.
             #
-            # Check if i-j.
-            if _has_both_edges(dag, i, j):
-                # Find nodes k where k is i->k.
-                succs_i = set()
-                for k in dag.successors(i):
-                    if not dag.has_edge(k, i):
-                        succs_i.add(k)
-                # Find nodes j where j is k->j.
-                preds_j = set()
-                for k in dag.predecessors(j):
-                    if not dag.has_edge(j, k):
-                        preds_j.add(k)
-                # Check if there is any node k where i->k->j.
-                if len(succs_i & preds_j) > 0:
-                    # Make i-j into i->j
-                    _logger.debug('R2: remove edge (%s, %s)' % (j, i))
-                    dag.remove_edge(j, i)
+            # Find nodes k where k is i->k.
+            succs_i = succ[i] & ~pred[i]
+            # Find nodes j where j is k->j.
+            preds_j = pred[j] & ~succ[j]
+            # Check if there is any node k where i->k->j.
+            if succs_i & preds_j:
+                # Make i-j into i->j
+                _logger.debug('R2: remove edge (%s, %s)', j, i)
+                _remove_edge(succ, pred, j, i)
+                continue
 
             # Rule 3: Orient i-j into i->j whenever there are two chains
             # i-k->j and i-l->j such that k and l are nonadjacent.
             #
-            # Check if i-j.
-            if _has_both_edges(dag, i, j):
-                # Find nodes k where i-k.
-                adj_i = set()
-                for k in dag.successors(i):
-                    if dag.has_edge(k, i):
-                        adj_i.add(k)
-                # For all the pairs of nodes in adj_i,
-                for (k, l) in combinations(adj_i, 2):
-                    # Skip if k and l are adjacent.
-                    if _has_any_edge(dag, k, l):
-                        continue
-                    # Skip if not k->j.
-                    if dag.has_edge(j, k) or (not dag.has_edge(k, j)):
-                        continue
-                    # Skip if not l->j.
-                    if dag.has_edge(j, l) or (not dag.has_edge(l, j)):
-                        continue
+            # Find nodes k where i-k and k->j.
+            cands = succ[i] & pred[i] & pred[j] & ~succ[j]
+            # For all the nodes k in cands,
+            rest = cands
+            while rest:
+                bit = rest & -rest
+                rest ^= bit
+                k = node_ids[bit.bit_length() - 1]
+                # Check if there is a node l in cands where k and l
+                # are nonadjacent.
+                if rest & ~(succ[k] | pred[k]):
                     # Make i-j into i->j.
-                    _logger.debug('R3: remove edge (%s, %s)' % (j, i))
-                    dag.remove_edge(j, i)
+                    _logger.debug('R3: remove edge (%s, %s)', j, i)
+                    _remove_edge(succ, pred, j, i)
                     break
 
             # Rule 4: Orient i-j into i->j whenever there are two chains
@@ -262,9 +384,11 @@ def estimate_cpdag(skel_graph, sep_set):
             # However, this rule is not necessary when the PC-algorithm
             # is used to estimate a DAG.
 
-        if nx.is_isomorphic(dag, old_dag):
+        # The rules only remove edges, so stop when nothing changed.
+        if succ == old_succ:
             break
-        old_dag = dag.copy()
+        old_succ = dict(succ)
+    dag.remove_edges_from(remove_edges)
 
     return dag
 
@@ -12,7 +12,7 @@ except ImportError:
     read_md = lambda f: open(f, 'r').read()
 
 setup(name='pcalg',
-      version='0.2.2',
+      version='0.3.0',
       description='CPDAG Estimation using PC-Algorithm',
       long_description=read_md('README.md'),
       author='Keiichi SHIMA',
@@ -13,6 +13,7 @@ import pytest
 from pcalg import estimate_cpdag
 from pcalg import estimate_skeleton
 
+@pytest.mark.parametrize('method', [None, 'stable'])
 @pytest.mark.parametrize(('indep_test_func', 'data_matrix', 'g_answer'), [
     (ci_test_bin, np.array(bin_data).reshape((5000, 5)), nx.DiGraph({
         0: (1, ),
@@ -29,17 +30,84 @@ from pcalg import estimate_skeleton
         4: (3, ),
     })),
 ])
-def test_estimate_cpdag(indep_test_func, data_matrix, g_answer, alpha=0.01):
+def test_estimate_cpdag(indep_test_func, data_matrix, g_answer, method,
+                        alpha=0.01):
     '''
     estimate_cpdag should reveal the answer
     '''
     (graph, sep_set) = estimate_skeleton(indep_test_func=indep_test_func,
                                          data_matrix=data_matrix,
-                                         alpha=alpha)
+                                         alpha=alpha,
+                                         method=method)
     graph = estimate_cpdag(skel_graph=graph, sep_set=sep_set)
     error_msg = 'True edges should be: %s' % (g_answer.edges(), )
     assert nx.is_isomorphic(graph, g_answer), error_msg
 
+@pytest.mark.parametrize('relabel', [
+    lambda n: 'x%d' % n,
+    lambda n: np.int64(n + 100),
+])
+def test_estimate_cpdag_node_labels(relabel):
+    '''
+    estimate_cpdag shall not depend on the node labels being 0..p-1
+    '''
+    data_matrix = np.array(bin_data).reshape((5000, 5))
+    (graph, sep_set) = estimate_skeleton(indep_test_func=ci_test_bin,
+                                         data_matrix=data_matrix,
+                                         alpha=0.01)
+    mapping = dict((n, relabel(n)) for n in graph.nodes())
+    g_answer = nx.relabel_nodes(
+        estimate_cpdag(skel_graph=graph, sep_set=sep_set), mapping)
+    r_sep_set = dict(
+        ((mapping[i], mapping[j]),
+         None if s is None else set(mapping[k] for k in s))
+        for ((i, j), s) in sep_set.items())
+    r_graph = estimate_cpdag(skel_graph=nx.relabel_nodes(graph, mapping),
+                             sep_set=r_sep_set)
+    assert set(r_graph.edges()) == set(g_answer.edges())
+
+def test_init_graph_numpy_labels():
+    '''
+    An init_graph with numpy integer nodes shall give the same CPDAG
+    '''
+    data_matrix = np.array(bin_data).reshape((5000, 5))
+    init_graph = nx.Graph()
+    init_graph.add_nodes_from(np.arange(5))
+    init_graph.add_edges_from((i, j) for i in np.arange(5)
+                              for j in np.arange(5) if i < j)
+    (graph, sep_set) = estimate_skeleton(indep_test_func=ci_test_bin,
+                                         data_matrix=data_matrix,
+                                         alpha=0.01,
+                                         init_graph=init_graph)
+    graph = estimate_cpdag(skel_graph=graph, sep_set=sep_set)
+    assert set(graph.edges()) == set([(0, 1), (2, 3), (3, 2), (3, 1),
+                                      (2, 4), (4, 2), (4, 1)])
+
+@pytest.mark.parametrize('method', [None, 'stable'])
+def test_init_graph_neighbor_order(method):
+    '''
+    The conditioning sets shall be tried in the order of the neighbors
+    in init_graph, even when its edges were not added in sorted order
+    '''
+    # 0 and 1 are separated by both {2} and {3}.  The neighbors of 0 are
+    # ordered 3, 2, 1 in init_graph, so {3} is found first.
+    init_graph = nx.Graph()
+    init_graph.add_nodes_from(range(4))
+    init_graph.add_edges_from([(0, 3), (0, 2), (0, 1), (2, 1), (3, 1)])
+    def fake_ci_test(data_matrix, x, y, s, **kwargs):
+        if frozenset((x, y)) == frozenset((0, 1)) and set(s) in ({2}, {3}):
+            return 1.0
+        return 0.0
+    (graph, sep_set) = estimate_skeleton(indep_test_func=fake_ci_test,
+                                         data_matrix=np.zeros((10, 4)),
+                                         alpha=0.01,
+                                         method=method,
+                                         init_graph=init_graph)
+    assert set(map(frozenset, graph.edges())) == set(
+        map(frozenset, [(0, 2), (0, 3), (1, 2), (1, 3)]))
+    assert sep_set == {(0, 1): {3}, (1, 0): {3},
+                       (2, 3): None, (3, 2): None}
+
 def test_fixed_edges():
     '''
     The fixed edges shall appear in the skeleton
@@ -69,3 +137,64 @@ def test_fixed_edges():
                                    alpha=0.01,
                                    fixed_edges=fixed_edges)
     assert graph.has_edge(1, 2), graph.edges
+
+def test_ci_test_cache():
+    '''
+    The same CI test shall not be run twice for a pair of nodes
+    '''
+    data_matrix = np.array(bin_data).reshape((5000, 5))
+    tested = []
+    def counting_ci_test_bin(data_matrix, x, y, s, **kwargs):
+        tested.append((min(x, y), max(x, y), frozenset(s)))
+        return ci_test_bin(data_matrix, x, y, s, **kwargs)
+    _ = estimate_skeleton(indep_test_func=counting_ci_test_bin,
+                          data_matrix=data_matrix,
+                          alpha=0.01,
+                          method='stable')
+    assert len(tested) == len(set(tested))
+
+def test_stable_skip_separated_pair():
+    '''
+    Once a pair is separated by the stable variant, the pair shall not
+    be tested again at the same level
+    '''
+    # 0 and 1 are separated by {2}, which is adjacent to 0 only.  (1, 0)
+    # would be tested with {3}, which is not in the CI test cache.
+    init_graph = nx.Graph([(0, 1), (0, 2), (1, 3), (2, 3)])
+    tested = []
+    def counting_ci_test(data_matrix, x, y, s, **kwargs):
+        tested.append((frozenset((x, y)), frozenset(s)))
+        if frozenset((x, y)) == frozenset((0, 1)) and set(s) == {2}:
+            return 1.0
+        return 0.0
+    (graph, sep_set) = estimate_skeleton(indep_test_func=counting_ci_test,
+                                         data_matrix=np.zeros((10, 4)),
+                                         alpha=0.01,
+                                         method='stable',
+                                         init_graph=init_graph)
+    assert not graph.has_edge(0, 1)
+    assert sep_set[(0, 1)] == {2}
+    assert (frozenset((0, 1)), frozenset((3, ))) not in tested
+
+def test_max_workers():
+    '''
+    The parallel stable variant shall give the same result as the
+    sequential one
+    '''
+    data_matrix = np.array(dis_data).reshape((10000, 5))
+    (graph, sep_set) = estimate_skeleton(indep_test_func=ci_test_dis,
+                                         data_matrix=data_matrix,
+                                         alpha=0.01,
+                                         method='stable')
+    (p_graph, p_sep_set) = estimate_skeleton(indep_test_func=ci_test_dis,
+                                             data_matrix=data_matrix,
+                                             alpha=0.01,
+                                             method='stable',
+                                             max_workers=2)
+    assert set(graph.edges()) == set(p_graph.edges())
+    assert sep_set == p_sep_set
+    with pytest.raises(ValueError):
+        _ = estimate_skeleton(indep_test_func=ci_test_dis,
+                              data_matrix=data_matrix,
+                              alpha=0.01,
+                              max_workers=2)